@@ -17,10 +17,51 @@ Output:
 """
 
 import argparse
+import collections
+import contextlib
+import errno
+import functools
+import io
+import itertools
 import json
+import os
 import shutil
+import sys
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# shutil.copy2 is still the fallback copy path; its default 64 KiB chunks
+# mean a lot of syscalls on multi-MB renders.
+if hasattr(shutil, "COPY_BUFSIZE"):
+    shutil.COPY_BUFSIZE = 1024 * 1024
+
+# background image copies (overlap with label computation): total budget shared
+# by the scenes running at once, at least one thread per scene
+IMAGE_COPY_THREADS = 16
+
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("--in", dest="inp", type=Path, required=True,
@@ -40,6 +81,25 @@ def parse_args():
                    help="Name of the generated Ultralytics YAML file (default: data.yaml).")
     p.add_argument("--clean", action="store_true",
                help="Delete out/images, out/labels, data.yaml and classes.txt before running.")
+    p.add_argument("--max-concurrency", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                   help="Number of scenes processed in parallel (default: half the CPU cores).")
+    p.add_argument("--executor", default="process", choices=["process", "thread"],
+                   help="Run scenes in worker processes (default) or threads.")
+    p.add_argument("--link", default="copy", choices=["copy", "auto", "hardlink", "reflink"],
+                   help="How images are placed into out/images (default: copy). auto tries hardlink, "
+                        "then reflink, then a copy. A hardlinked output image IS the input file: "
+                        "editing out/images in place (resize, re-encode) changes the source dataset.")
+    p.add_argument("--stream-json", action="store_true",
+                   help="Parse scene_instances.json incrementally with ijson to keep memory low "
+                        "on very large scenes (requires ijson).")
+    p.add_argument("--incremental", action="store_true",
+                   help="Skip images whose image and label file already exist and are newer than "
+                        "their scene_instances.json. Only used after a completed run with the same "
+                        "--label-field (class ids are kept from its .manifest.json).")
+    p.add_argument("--tar-output", type=Path, default=None,
+                   help="Stream images/, labels/ and the YAML into this tar file instead of "
+                        "writing them under --out (one big write for network filesystems). "
+                        "--out is still used as 'path:' in the YAML.")
     return p.parse_args()
 
 def yolo_bbox(xmin, ymin, xmax, ymax, w, h):
@@ -56,69 +116,356 @@ def yolo_bbox(xmin, ymin, xmax, ymax, w, h):
     cy = ymin + bh / 2.0
     return cx / w, cy / h, bw / w, bh / h
 
-def label_from_instance(inst, mode="class"):
-    '''
-    Getting label for yolo data.yaml, based on "mode"
-    '''
-    if mode == "class":
-        return inst.get("class")
-    if mode == "subclass":
-        return inst.get("subclass")
-    if mode == "superclass":
-        return inst.get("superclass")
-    if mode == "path":
-        p = inst.get("path")
-        return p.split("/")[-1] if isinstance(p, str) else None
-    if mode == "class_subclass":
-        c = inst.get("class")
-        s = inst.get("subclass")
-        if c and s:
-            return f"{c}/{s}"
-        return c or s
-    return None
+def yolo_bboxes(boxes, w, h):
+    '''
+    yolo_bbox for many boxes at once.
+    [(x_min, y_min, x_max, y_max), ...] -> [(x_center, y_center, width, height), ...]
+    Returns an (N, 4) array with numpy, a list of tuples without it.
+    With numpy, w and h may also be (N,) arrays (one image size per box).
+    '''
+    if np is None:
+        return [yolo_bbox(float(x0), float(y0), float(x1), float(y1), w, h) for x0, y0, x1, y1 in boxes]
+    # float64 keeps the printed values identical to yolo_bbox
+    b = np.asarray(boxes, dtype=np.float64)
+    size = np.column_stack((w, h, w, h))
+    np.clip(b, 0, size - 1, out=b)
+    out = np.empty_like(b)
+    np.subtract(b[:, 2:4], b[:, 0:2], out=out[:, 2:4])
+    np.maximum(out[:, 2:4], 0.0, out=out[:, 2:4])
+    np.multiply(out[:, 2:4], 0.5, out=out[:, 0:2])
+    np.add(b[:, 0:2], out[:, 0:2], out=out[:, 0:2])
+    out /= size
+    return out
+
+def scene_yolo_rows(items):
+    '''
+    Convert the boxes of every image in a scene in one numpy pass; per image
+    calls cost more than the math itself for typical instance counts.
+    items: [(out_lbl, cids, boxes, w, h), ...] -> [(kept_cids, rows), ...]
+    Zero-area boxes are dropped (like yolo_bbox callers always did).
+    '''
+    if np is None:
+        result = []
+        for _, cids, boxes, w, h in items:
+            rows = yolo_bboxes(boxes, float(w), float(h)) if boxes else []
+            keep = [not (r[2] <= 0 or r[3] <= 0) for r in rows]
+            result.append(([c for c, k in zip(cids, keep) if k], [r for r, k in zip(rows, keep) if k]))
+        return result
+
+    counts = [len(boxes) for _, _, boxes, _, _ in items]
+    if not any(counts):
+        return [([], []) for _ in items]
+    boxes = [b for _, _, img_boxes, _, _ in items for b in img_boxes]
+    cids = np.fromiter((c for _, img_cids, _, _, _ in items for c in img_cids), dtype=np.intp, count=len(boxes))
+    # images without boxes may have no size at all, they contribute no rows anyway
+    w = np.repeat([float(w) if n else 1.0 for n, (_, _, _, w, _) in zip(counts, items)], counts)
+    h = np.repeat([float(h) if n else 1.0 for n, (_, _, _, _, h) in zip(counts, items)], counts)
+    rows = yolo_bboxes(boxes, w, h)
+    keep = ~((rows[:, 2] <= 0) | (rows[:, 3] <= 0))
+    bounds = np.cumsum(counts)[:-1]
+    return [(c[k], r[k]) for c, r, k in zip(np.split(cids, bounds), np.split(rows, bounds), np.split(keep, bounds))]
+
+def image_size(path):
+    '''
+    (width, height) read from the image header, None without PIL or on a broken file.
+    '''
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as im:
+            return im.size
+    except Exception:
+        return None
+
+def _class_subclass(inst):
+    c = inst.get("class")
+    s = inst.get("subclass")
+    if c and s:
+        return f"{c}/{s}"
+    return c or s
+
+def _path_leaf(inst):
+    p = inst.get("path")
+    return p.split("/")[-1] if isinstance(p, str) else None
+
+# one line of a YOLO label file
+LABEL_ROW_FMT = "%d %.6f %.6f %.6f %.6f"
+
+# label mode -> getter, picked once per scene instead of per instance
+LABEL_GETTERS = {
+    "class": lambda inst: inst.get("class"),
+    "subclass": lambda inst: inst.get("subclass"),
+    "superclass": lambda inst: inst.get("superclass"),
+    "path": _path_leaf,
+    "class_subclass": _class_subclass,
+}
 
 def find_scene_dirs(root: Path):
-    return [p for p in root.rglob("scene_instances.json")]
+    '''
+    All scene_instances.json under root. os.walk instead of rglob: no Path
+    object and no stat per directory entry. Directories are visited in sorted
+    order so class ids don't depend on the filesystem's listing order.
+    '''
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=False):
+        dirnames.sort()
+        if "scene_instances.json" in filenames:
+            found.append(Path(dirpath, "scene_instances.json"))
+    return found
 
 def ensure_dirs(out_root: Path):
     (out_root / "images").mkdir(parents=True, exist_ok=True)
     (out_root / "labels").mkdir(parents=True, exist_ok=True)
 
-def resolve_image_path(scene_dir: Path, fname: str | None, exts):
+def scan_scene_dir(scene_dir: Path, exts):
+    '''
+    One os.scandir() per scene instead of a glob per image and extension.
+    Returns cache for resolve_image_path:
+      files: name -> DirEntry of every file in scene_dir
+      fallback: image used when file_name can't be resolved
+                (beauty.* first, checked per allowed extension in order)
+    '''
+    with os.scandir(scene_dir) as it:
+        files = {e.name: e for e in it if e.is_file()}
+    fallback = None
+    for ext in exts:
+        cand = [e for n, e in files.items() if n.endswith(ext) and not n.startswith(".")]
+        beauty = [e for e in cand if e.name.startswith("beauty.")]
+        if beauty or cand:
+            fallback = (beauty or cand)[0].path
+            break
+    return {"dir": os.fspath(scene_dir), "files": files, "fallback": fallback}
+
+def resolve_image_path(cache, fname: str | None):
     '''
     1. Looking directly by path 
     2. Running through all alowed extensions
+    Returns a str path (or None).
     '''
+    files = cache["files"]
     if fname:
-        p = (scene_dir / fname)
-        if p.exists():
-            return p
-        p = scene_dir / Path(fname).name
-        if p.exists():
-            return p
-    for ext in exts:
-        cand = list(scene_dir.glob(f"*{ext}"))
-        beauty = [c for c in cand if c.name.startswith("beauty.")]
-        if beauty:
-            return beauty[0]
-        if cand:
-            return cand[0]
-    return None
+        if fname in files:
+            return files[fname].path
+        name = os.path.basename(fname)
+        if name != fname:
+            # file_name with sub-directories
+            p = os.path.join(cache["dir"], fname)
+            if os.path.exists(p):
+                return p
+            if name in files:
+                return files[name].path
+    return cache["fallback"]
+
+# errors after which --link auto moves on to the next method
+_LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP,
+                         errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL, errno.ENOTTY}
+
+def _fast_copy(src, dst):
+    '''
+    Copy src -> dst inside the kernel (copy_file_range / sendfile / CopyFileExW),
+    falling back to shutil.copy2. Keeps the source mtime like copy2 does.
+    dst is created exclusively: an existing dst raises FileExistsError and is left untouched.
+    '''
+    src, dst = os.fspath(src), os.fspath(dst)
+    if sys.platform == "win32":
+        import ctypes
+        COPY_FILE_FAIL_IF_EXISTS = 0x1
+        if not ctypes.windll.kernel32.CopyFileExW(src, dst, None, None, None, COPY_FILE_FAIL_IF_EXISTS):
+            if os.path.exists(dst):
+                raise FileExistsError(errno.EEXIST, "File exists", dst)
+            with open(dst, "xb"):
+                pass
+            shutil.copy2(src, dst)
+        return
+
+    st = os.stat(src)
+    out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        in_fd = os.open(src, os.O_RDONLY)
+        try:
+            use_cfr = hasattr(os, "copy_file_range")
+            offset = 0
+            while offset < st.st_size:
+                if use_cfr:
+                    try:
+                        n = os.copy_file_range(in_fd, out_fd, st.st_size - offset, offset, offset)
+                    except OSError:
+                        # cross-device on old kernels, unsupported fs, ...
+                        n = 0
+                    if n == 0:
+                        # some filesystems report 0 instead of an error: retry with sendfile
+                        use_cfr = False
+                        os.lseek(out_fd, offset, os.SEEK_SET)
+                        continue
+                else:
+                    n = os.sendfile(out_fd, in_fd, offset, st.st_size - offset)
+                    if n == 0:
+                        raise OSError(errno.EIO, "sendfile() stopped before the end of the file", src)
+                offset += n
+            if offset != st.st_size:
+                raise OSError(errno.EIO, f"copied {offset} of {st.st_size} bytes", src)
+        finally:
+            os.close(in_fd)
+    except OSError:
+        # e.g. sendfile() into a regular file is unsupported on this platform;
+        # dst is the file we just created, so overwriting it is safe
+        os.close(out_fd)
+        shutil.copy2(src, dst)
+        return
+    os.close(out_fd)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def _reflink(src, dst):
+    '''
+    Copy-on-write clone (FICLONE ioctl, Btrfs/XFS). Raises OSError if unsupported.
+    dst is created exclusively, like in _fast_copy.
+    '''
+    import fcntl
+    ficlone = getattr(fcntl, "FICLONE", 0x40049409)
+    out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        in_fd = os.open(src, os.O_RDONLY)
+        try:
+            fcntl.ioctl(out_fd, ficlone, in_fd)
+        finally:
+            os.close(in_fd)
+    except OSError:
+        # only ever removes the empty file created above
+        os.close(out_fd)
+        os.unlink(dst)
+        raise
+    os.close(out_fd)
+    st = os.stat(src)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def place_image(src, dst, mode="copy"):
+    '''
+    Put src at dst according to --link mode.
+    "auto": hardlink -> reflink (cross-device) -> copy
+    An existing dst counts as already placed and is never overwritten.
+    '''
+    try:
+        if mode in ("auto", "hardlink"):
+            try:
+                os.link(src, dst)
+                return
+            except OSError as e:
+                if mode == "hardlink" or e.errno not in _LINK_FALLBACK_ERRNOS:
+                    raise
+        if mode in ("auto", "reflink") and sys.platform.startswith("linux"):
+            try:
+                _reflink(src, dst)
+                return
+            except OSError as e:
+                if mode == "reflink" or e.errno not in _LINK_FALLBACK_ERRNOS:
+                    raise
+        elif mode == "reflink":
+            raise OSError(errno.ENOTSUP, "reflink is only supported on Linux", os.fspath(src))
+        _fast_copy(src, dst)
+    except FileExistsError:
+        pass
+
+def write_label_files(pending):
+    '''
+    Write all label files of a scene: [(path, bytes), ...]
+    Plain os.open/os.write, no Path/TextIOWrapper machinery per file.
+    '''
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    for path, data in pending:
+        fd = os.open(path, flags, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
 
-def write_data_yaml(out_root: Path, class_list: list[str], yaml_name: str):
+class TarOutput:
+    '''
+    Stream-mode tar used instead of out/images + out/labels (--tar-output).
+    Only the main process writes to it (see merge_scene).
+    The archive is written to PATH.tmp and only renamed to PATH by close(),
+    so a failed run never leaves a complete-looking archive behind.
+    '''
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.fileobj = open(self.tmp_path, "wb")
+        # dereference: a symlinked source image is stored as the image bytes
+        self.tar = tarfile.open(fileobj=self.fileobj, mode="w|", dereference=True)
+
+    def add_file(self, src, arcname: str):
+        self.tar.add(src, arcname=arcname, recursive=False)
+
+    def add_bytes(self, arcname: str, data: bytes):
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        '''
+        Finalize the archive and move it into place.
+        '''
+        self.tar.close()
+        self.fileobj.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        '''
+        Drop the partial archive without writing the end-of-archive blocks.
+        '''
+        self.fileobj.close()
+        with contextlib.suppress(FileNotFoundError):
+            self.tmp_path.unlink()
+
+def data_yaml_bytes(out_root: Path, class_list: list[str]) -> bytes:
     """
-    Write a minimal Ultralytics YAML with no split: both train and val point to 'images/'.
+    A minimal Ultralytics YAML with no split: both train and val point to 'images/'.
     """
     content_lines = [
         f"path: {out_root.as_posix()}",
         "train: images",
         "val: images",
-        "names:"
+        "names:",
+        *(f"  {cls_num}: {name}" for cls_num, name in enumerate(class_list)),
+        "",
     ]
-    
-    for cls_num in range(len(class_list)):
-        content_lines.append(f"  {cls_num}: {class_list[cls_num]}")
-    (out_root / yaml_name).write_text("\n".join(content_lines) + "\n", encoding="utf-8")
+    return "\n".join(content_lines).encode("utf-8")
+
+# what --incremental needs to trust label files left by an earlier run
+MANIFEST_NAME = ".manifest.json"
+
+def read_manifest(out_root: Path):
+    """
+    {"label_field": ..., "classes": [...], "images": {key: [instances, skipped]}}
+    of the last completed run, None if missing/broken.
+    """
+    try:
+        manifest = json.loads((out_root / MANIFEST_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("classes"), list):
+        return None
+    return manifest
+
+def write_manifest(out_root: Path, label_field: str, class_list: list[str], image_stats: dict):
+    """
+    Written atomically, and only once all label files and the YAML are on disk.
+    image_stats ("<label file>#<image id>" -> [instances, skipped]) lets
+    --incremental report the same counts as a full run.
+    """
+    tmp = out_root / (MANIFEST_NAME + ".tmp")
+    manifest = {"label_field": label_field, "classes": class_list, "images": image_stats}
+    tmp.write_text(json.dumps(manifest), encoding="utf-8")
+    os.replace(tmp, out_root / MANIFEST_NAME)
+
+def write_data_yaml(out_root: Path, class_list: list[str], yaml_name: str):
+    """
+    Write a minimal Ultralytics YAML with no split: both train and val point to 'images/'.
+    """
+    (out_root / yaml_name).write_bytes(data_yaml_bytes(out_root, class_list))
 
 def clean_output(out_root: Path, yaml_name: str):
     '''
@@ -128,134 +475,303 @@ def clean_output(out_root: Path, yaml_name: str):
         d = out_root / sub
         if d.exists() and d.is_dir():
             shutil.rmtree(d)
-    for fname in ["classes.txt", yaml_name]:
+    for fname in ["classes.txt", yaml_name, MANIFEST_NAME]:
         f = out_root / fname
         if f.exists():
             f.unlink()
 
-def main():
-    args = parse_args()
-    in_root: Path = args.inp
-    out_root: Path = args.out
-
-    if args.clean:
-        clean_output(out_root, args.yaml_name)
-
-    ensure_dirs(out_root)
-
-    classes = {}
-    next_cid = 0
-    stats = {"images": 0, "instances": 0, "skipped_instances": 0, "scenes": 0}
-
-    # iterating through each scene_insatnces.json
-    for json_path in find_scene_dirs(in_root):
-        scene_dir = json_path.parent
-        stats["scenes"] += 1
-        try:
-            data = json.loads(json_path.read_text(encoding="utf-8"))
-        except Exception as e:
-            msg = f"[WARN] Failed to read {json_path}: {e}"
-            if args.strict: raise RuntimeError(msg)
-            print(msg); continue
-
-        images = data.get("images", [])
-        instances = data.get("instances", [])
+def load_scene(json_path: Path, image_key: str, label_fn, stream: bool = False):
+    '''
+    Read scene_instances.json -> (img_map, per_image, orphans)
+    img_map: image_id -> {file_name, width, height}
+    per_image: image_id -> list of (label, bbox), label from label_fn
+    orphans: number of instances pointing to an unknown image_id
+    Only label and bbox are kept per instance. With stream=True, ijson walks
+    images[] and instances[] record by record, so the rest of each record
+    (path, area, asset, ...) is never held for the whole scene.
+    '''
+    if not stream:
+        data = _json_loads(json_path.read_bytes())
 
-        # map - images:meta
-        img_map = {}
+    # map - images:meta
+    img_map = {}
+    with open(json_path, "rb") if stream else contextlib.nullcontext() as f:
+        images = ijson.items(f, "images.item", use_float=True) if stream else data.get("images", [])
         for im in images:
             iid = im.get("id")
-            file_name = im.get(args.image_key)
+            file_name = im.get(image_key)
             width = im.get("width")
             height = im.get("height")
             img_map[iid] = {"file_name": file_name, "width": width, "height": height}
 
-        # map - image_id:list_of_instances
-        per_image = {iid: [] for iid in img_map.keys()}
+    # map - image_id:list_of_(label, bbox)
+    per_image = {iid: [] for iid in img_map.keys()}
+    orphans = 0
+    with open(json_path, "rb") if stream else contextlib.nullcontext() as f:
+        instances = ijson.items(f, "instances.item", use_float=True) if stream else data.get("instances", [])
         for inst in instances:
             iid = inst.get("image_id")
             if iid not in per_image:
-                stats["skipped_instances"] += 1
+                orphans += 1
                 continue
-            per_image[iid].append(inst)
+            per_image[iid].append((label_fn(inst), inst.get("bbox")))
+    return img_map, per_image, orphans
 
-        # for every image:
-        # 1. find by path
-        # 2. create new name
-        # 3. copy it to output
-        # 4. create txt file 
+def process_scene(json_path: Path, args):
+    '''
+    Convert one scene_instances.json. Runs in a worker process, so nothing is shared:
+    class ids are local to the scene and remapped by the parent (merge_scene).
+    Returns (stats, scene_classes, labels, tar_images, image_counts, up_to_date)
+      scene_classes: labels in first-seen order, index = local class id
+      labels: [(out_lbl, local_cids, [(x, y, bw, bh), ...]), ...]
+      tar_images: [(src_img, new_name), ...] left for the parent with --tar-output
+      image_counts: [(key, n_instances, n_skipped), ...] per converted image
+      up_to_date: [(key, n_lines), ...] images skipped by --incremental; their
+                  counts come from the manifest (see merge_scene)
+    '''
+    out_root: Path = args.out
+    scene_dir = json_path.parent
+    local = {"images": 0, "instances": 0, "skipped_instances": 0, "scenes": 1}
+    # label -> local class id, ids handed out in first-seen order
+    scene_classes = collections.defaultdict(itertools.count().__next__)
+    labels = []
+    tar_images = []
+    image_counts = []
+    up_to_date = []
+    try:
+        img_map, per_image, orphans = load_scene(json_path, args.image_key,
+                                                 LABEL_GETTERS[args.label_field], args.stream_json)
+    except Exception as e:
+        msg = f"[WARN] Failed to read {json_path}: {e}"
+        if args.strict: raise RuntimeError(msg)
+        print(msg); return local, [], labels, tar_images, image_counts, up_to_date
+    local["skipped_instances"] += orphans
+    json_mtime = os.stat(json_path).st_mtime if args.incremental else None
+    scene_cache = scan_scene_dir(scene_dir, args.image_extensions)
+    # plain strings in the per-image loop, Path only at the boundaries
+    name_prefix = scene_dir.name + "_"
+    images_dir = os.path.join(out_root, "images", "")
+    labels_dir = os.path.join(out_root, "labels", "")
+
+    # for every image:
+    # 1. find by path
+    # 2. create new name
+    # 3. copy it to output
+    # 4. collect label rows
+    # image copies (3.) run in the background while the labels are computed
+    queued = set()
+    pending = []
+    pending_info = []
+    with contextlib.ExitStack() as stack:
+        # created on the first real copy: not needed for tar output or plain hardlinks
+        copier = None
+        copy_threads = max(1, IMAGE_COPY_THREADS // max(1, args.max_concurrency))
+        copies = []
         for iid, meta in img_map.items():
             fname = meta.get("file_name")
             w = meta.get("width")
             h = meta.get("height")
 
-            src_img = resolve_image_path(scene_dir, fname, args.image_extensions)
-            if src_img is None or not src_img.exists():
+            src_img = resolve_image_path(scene_cache, fname)
+            if src_img is None:
                 msg = f"[WARN] Missing image for iid={iid} (declared '{fname}') in {scene_dir}"
                 if args.strict: raise FileNotFoundError(msg)
                 print(msg); continue
 
-            new_name = f"{scene_dir.name}_{src_img.name}"
-            out_img = out_root / "images" / new_name
-            out_lbl = out_root / "labels" / (Path(new_name).stem + ".txt")
+            new_name = name_prefix + os.path.basename(src_img)
+            out_img = images_dir + new_name
+            out_lbl = labels_dir + os.path.splitext(new_name)[0] + ".txt"
+            # one label file can be shared by several image ids (resolve fallback)
+            count_key = f"{os.path.basename(out_lbl)}#{iid}"
+
+            if (json_mtime is not None and os.path.exists(out_img) and os.path.exists(out_lbl)
+                    and os.path.getmtime(out_lbl) >= json_mtime):
+                # up to date from a previous run
+                with open(out_lbl, "rb") as f:
+                    data = f.read()
+                local["images"] += 1
+                up_to_date.append((count_key, (data.count(b"\n") + 1) if data else 0))
+                continue
 
-            if not out_img.exists():
-                shutil.copy2(src_img, out_img)
+            if out_img not in queued:
+                queued.add(out_img)
+                if args.tar_output:
+                    tar_images.append((src_img, new_name))
+                elif args.link == "hardlink":
+                    place_image(src_img, out_img, args.link)
+                else:
+                    # an out_img that already exists (earlier run, or a scene with the
+                    # same name) is detected by the exclusive create in place_image
+                    if copier is None:
+                        copier = stack.enter_context(ThreadPoolExecutor(max_workers=copy_threads))
+                    copies.append(copier.submit(place_image, src_img, out_img, args.link))
 
             # getting data for txt file
             # (cls_id, ...yolo_bbox)
-            lines = []
-            for inst in per_image[iid]:
+            cids, boxes = [], []
+            dropped = 0
+            for lab, bbox in per_image[iid]:
                 # getting label
-                lab = label_from_instance(inst, args.label_field)
                 if lab is None:
-                    stats["skipped_instances"] += 1
+                    dropped += 1
                     continue
-                if lab not in classes:
-                    classes[lab] = next_cid
-                    next_cid += 1
-                cid = classes[lab]
-                
-                # getting bbox
-                bbox = inst.get("bbox")
+                cid = scene_classes[lab]
+            
+                # checking bbox
                 if not bbox or len(bbox) != 4:
-                    stats["skipped_instances"] += 1
-                    continue
-
-                xmin, ymin, xmax, ymax = bbox
-                if w is None or h is None:
-                    try:
-                        from PIL import Image
-                        with Image.open(src_img) as im:
-                            w, h = im.size
-                    except Exception:
-                        msg = f"[WARN] Missing width/height for {src_img}, and PIL not available."
-                        if args.strict: raise RuntimeError(msg)
-                        print(msg); continue
-
-                x, y, bw, bh = yolo_bbox(float(xmin), float(ymin), float(xmax), float(ymax), float(w), float(h))
-                if bw <= 0 or bh <= 0:
-                    stats["skipped_instances"] += 1
+                    dropped += 1
                     continue
+                cids.append(cid)
+                boxes.append(bbox)
+
+            if boxes and (w is None or h is None):
+                size = image_size(src_img)
+                if size is None:
+                    msg = f"[WARN] Missing width/height for {src_img}, and PIL not available."
+                    if args.strict: raise RuntimeError(msg)
+                    print(msg); boxes = []
+                else:
+                    w, h = size
+
+            if not boxes:
+                cids = []
+            pending.append((out_lbl, cids, boxes, w, h))
+            pending_info.append((count_key, dropped))
+
+        # all boxes of the scene converted at once
+        for (out_lbl, cids, _, _, _), (count_key, dropped), (kept_cids, rows) in zip(
+                pending, pending_info, scene_yolo_rows(pending)):
+            n_skipped = dropped + len(cids) - len(rows)
+            labels.append((out_lbl, kept_cids, rows))
+            image_counts.append((count_key, len(rows), n_skipped))
+            local["images"] += 1
+            local["instances"] += len(rows)
+            local["skipped_instances"] += n_skipped
+
+        for fut in copies:
+            fut.result()
+
+    return local, list(scene_classes), labels, tar_images, image_counts, up_to_date
+
+@functools.lru_cache(maxsize=1024)
+def label_template(n: int) -> str:
+    '''
+    Format string for a whole label file with n rows, built once per row count.
+    '''
+    return "\n".join([LABEL_ROW_FMT] * n)
 
-                lines.append(f"{cid} {x:.6f} {y:.6f} {bw:.6f} {bh:.6f}")
+def format_labels(cids, rows, remap) -> bytes:
+    '''
+    Label file content for one image: class_id x_center y_center w h per line.
+    cids are scene-local and mapped through remap. All rows go through a single
+    %-format call instead of one f-string (5 float formats) per line.
+    '''
+    if not len(rows):
+        return b""
+    if np is not None:
+        flat = np.column_stack((remap[cids], rows)).ravel().tolist()
+    else:
+        flat = [v for cid, row in zip(cids, rows) for v in (remap[cid], *row)]
+    return (label_template(len(rows)) % tuple(flat)).encode("utf-8")
+
+def merge_scene(result, classes, stats, image_stats, prev_image_stats, tar=None):
+    '''
+    Parent side of process_scene: map scene-local class ids to global ones
+    (first seen, in scene order) and write the label files / tar members.
+    image_stats collects [instances, skipped] per image for the manifest; images
+    left alone by --incremental take theirs from prev_image_stats.
+    '''
+    local, scene_classes, labels, tar_images, image_counts, up_to_date = result
+    for k, v in local.items():
+        stats[k] += v
+    for key, n_instances, n_skipped in image_counts:
+        image_stats[key] = [n_instances, n_skipped]
+    for key, n_lines in up_to_date:
+        n_instances, n_skipped = prev_image_stats.get(key, (n_lines, 0))
+        stats["instances"] += n_instances
+        stats["skipped_instances"] += n_skipped
+        image_stats[key] = [n_instances, n_skipped]
+    remap = [classes[lab] for lab in scene_classes]
+    if np is not None:
+        remap = np.asarray(remap, dtype=np.int64)
+
+    pending_labels = [(out_lbl, format_labels(cids, rows, remap)) for out_lbl, cids, rows in labels]
+
+    if tar is not None:
+        for src_img, new_name in tar_images:
+            tar.add_file(src_img, "images/" + new_name)
+        # like on disk, the last label written for a name wins
+        for out_lbl, data in dict(pending_labels).items():
+            tar.add_bytes("labels/" + os.path.basename(out_lbl), data)
+    else:
+        write_label_files(pending_labels)
 
-            out_lbl.write_text("\n".join(lines), encoding="utf-8")
-            stats["images"] += 1
-            stats["instances"] += len(lines)
+def main():
+    args = parse_args()
+    if args.stream_json and ijson is None:
+        raise SystemExit("--stream-json requires the 'ijson' package (pip install ijson).")
+    if args.incremental and args.tar_output:
+        raise SystemExit("--incremental works on the --out directory and can't be used with --tar-output.")
+    in_root: Path = args.inp
+    out_root: Path = args.out
 
+    if args.clean:
+        clean_output(out_root, args.yaml_name)
 
-    inv = [None] * len(classes)
-    for k, v in classes.items():
-        inv[v] = k
+    tar = TarOutput(args.tar_output) if args.tar_output else None
+    if tar is None:
+        ensure_dirs(out_root)
+
+    classes = collections.defaultdict(itertools.count().__next__)
+    image_stats, prev_image_stats = {}, {}
+    if args.incremental:
+        manifest = read_manifest(out_root)
+        if manifest is None or manifest.get("label_field") != args.label_field:
+            print(f"[WARN] No matching {MANIFEST_NAME} in {out_root} (previous run incomplete, or "
+                  f"--label-field changed); converting everything.")
+            args.incremental = False
+        else:
+            # keep the ids already used by the label files we are going to skip
+            for name in manifest["classes"]:
+                classes[name]
+            prev_image_stats = manifest.get("images") or {}
+    if tar is None:
+        # label files are about to change; the manifest comes back only if this run completes
+        with contextlib.suppress(FileNotFoundError):
+            (out_root / MANIFEST_NAME).unlink()
+    stats = {"images": 0, "instances": 0, "skipped_instances": 0, "scenes": 0}
 
-    # here yaml file gets written 
-    write_data_yaml(out_root, inv, args.yaml_name)
+    # iterating through each scene_insatnces.json, one task per scene;
+    # results are merged in scene order so class ids don't depend on timing
+    executor = ProcessPoolExecutor if args.executor == "process" else ThreadPoolExecutor
+    try:
+        with executor(max_workers=args.max_concurrency) as pool:
+            for result in pool.map(process_scene, find_scene_dirs(in_root), itertools.repeat(args)):
+                merge_scene(result, classes, stats, image_stats, prev_image_stats, tar)
+
+        # ids were handed out in insertion order
+        inv = list(classes)
+
+        # here yaml file gets written 
+        if tar is not None:
+            tar.add_bytes(args.yaml_name, data_yaml_bytes(out_root, inv))
+            tar.close()
+    except BaseException:
+        if tar is not None:
+            tar.abort()
+        raise
+
+    if tar is None:
+        write_data_yaml(out_root, inv, args.yaml_name)
+        write_manifest(out_root, args.label_field, inv, image_stats)
 
     print(f"[DONE] Scenes: {stats['scenes']}, Images: {stats['images']}, "
           f"YOLO instances: {stats['instances']}, Skipped instances: {stats['skipped_instances']}")
-    print(f"[INFO] Wrote: {out_root/'images'}  and  {out_root/'labels'}")
-    print(f"[INFO] Dataset YAML -> {out_root/args.yaml_name}")
+    if tar is not None:
+        print(f"[INFO] Wrote: images/, labels/ and {args.yaml_name} -> {args.tar_output}")
+    else:
+        print(f"[INFO] Wrote: {out_root/'images'}  and  {out_root/'labels'}")
+        print(f"[INFO] Dataset YAML -> {out_root/args.yaml_name}")
 
 if __name__ == "__main__":
     main()